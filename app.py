@@ -1,107 +1,283 @@
 import os
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+import httpx
 import streamlit as st
 from google import genai
+from google.genai import types
+from google.genai.models import Models
 from google.genai.errors import APIError
 from dotenv import load_dotenv
 
 # --- 1. CONFIGURATION AND CLIENT INITIALIZATION ---
 
-# Load environment variables from the .env file (if running locally)
-load_dotenv()
+@st.cache_resource(show_spinner=False)
+def _load_api_key():
+    """
+    Loads the .env file (if running locally) and caches the Gemini API key once it is found.
+    A missing key raises instead, so it isn't cached and the next rerun looks again.
+    """
+    load_dotenv()
+    key = os.getenv("GEMINI_API_KEY")
+    if not key:
+        raise LookupError("GEMINI_API_KEY is not set")
+    return key
+
+def _get_api_key():
+    """Returns the Gemini API key, or None if it isn't set yet."""
+    try:
+        return _load_api_key()
+    except LookupError:
+        return None
 
 # The client will automatically pick up the key from the environment
-API_KEY = os.getenv("GEMINI_API_KEY")
+API_KEY = _get_api_key()
 
 @st.cache_resource
 def load_gemini_client(key):
-    """Initializes and caches the Gemini client."""
+    """
+    Initializes and caches the Gemini client.
+    The client holds a warm HTTP connection pool shared by every rerun and session,
+    so it must never be closed by user code.
+    """
     if not key:
         return None 
     try:
-        # Initializing client with the key
-        client = genai.Client(api_key=key)
+        # Small keep-alive pool so the cached client reuses warm connections across reruns
+        try:
+            http_options = types.HttpOptions(
+                client_args={'limits': httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300)}
+            )
+        except (TypeError, ValueError):
+            # Older SDKs don't accept client_args; use their default transport
+            http_options = None
+
+        # Initializing client with the key and, when supported, the keep-alive transport
+        if http_options is None:
+            client = genai.Client(api_key=key)
+        else:
+            client = genai.Client(api_key=key, http_options=http_options)
         return client
     except Exception as e:
         # In a real deployed environment, st.secrets is used, but for local use we check .env
         st.error(f"Error initializing Gemini client. Check your GEMINI_API_KEY in .env or secrets: {e}")
         return None
 
-# --- 2. GENERATION FUNCTION ---
+@st.cache_resource
+def load_story_streamer(key):
+    """Caches the client's bound generate_content_stream so each generation skips the attribute lookups."""
+    client = load_gemini_client(key)
+    if client is None:
+        return None
+    return client.models.generate_content_stream
+
+# --- 2. PROMPT TEMPLATE ---
 
-def generate_story_stream(client: genai.Client, user_details: dict):
+# Define the System Instruction (fixed for every story)
+SYSTEM_INSTRUCTION_TEXT = (
+    "You are a magical storyteller. You must write a creative, engaging, and unique short story "
+    "based ONLY on the user's provided details. Structure the story with an introduction, conflict, and resolution. "
+    "The story should have a clear beginning and end."
+)
+
+@st.cache_resource(show_spinner=False)
+def load_story_config():
     """
-    Constructs the prompt and streams the generated story.
-    Includes fallback logic for older SDKs that don't support system_instruction.
+    Probes once per process whether the installed SDK accepts a config (carrying system_instruction)
+    and, if so, builds that config. Returns None for legacy SDKs.
+    The returned config is shared by every rerun and session, so it must not be mutated.
+    """
+    try:
+        params = inspect.signature(Models.generate_content_stream).parameters
+    except (TypeError, ValueError):
+        return None
+    if 'config' not in params:
+        return None
+    return types.GenerateContentConfig(system_instruction=SYSTEM_INSTRUCTION_TEXT)
+
+# Prefix used by the legacy SDK path, which has no config argument
+FALLBACK_PROMPT_PREFIX = f"{SYSTEM_INSTRUCTION_TEXT}\n\nUSER PROMPT:\n"
+
+# Constant fragments of the user prompt; the user's values are joined in between.
+# The whitespace (4-space indents, the "    " blank line) matches the original f-string exactly.
+_PROMPT_PARTS = (
+    "\n    Please write a personalized story for the main character named '",
+    "'.\n    \n    Story Theme/Genre: ",
+    "\n    Key Setting/Location: ",
+    "\n    Length: ",
+    " words.\n\n    The main character, ",
+    ", loves ",
+    " and their defining personality trait is ",
+    ".\n    Begin the story now:\n    ",
+)
+
+def build_prompt(user_details: dict) -> str:
+    """Assembles the user prompt from the constant template fragments."""
+    return "".join((
+        _PROMPT_PARTS[0], user_details['name'],
+        _PROMPT_PARTS[1], user_details['theme'],
+        _PROMPT_PARTS[2], user_details['setting'],
+        _PROMPT_PARTS[3], str(user_details['length']),
+        _PROMPT_PARTS[4], user_details['name'],
+        _PROMPT_PARTS[5], user_details['hobby'],
+        _PROMPT_PARTS[6], user_details['trait'],
+        _PROMPT_PARTS[7],
+    ))
+
+# --- 3. GENERATION FUNCTION ---
+
+# Finished stories are reused for identical details for up to an hour,
+# and at most this many are kept (oldest evicted first)
+STORY_TTL_SECONDS = 3600
+MAX_STORED_STORIES = 256
+
+@st.cache_resource
+def _story_store():
+    """Process-wide memo of finished stories (shared by every session) and the lock guarding it."""
+    return OrderedDict(), threading.Lock()
+
+def get_cached_story(story_key: tuple):
+    """Returns the memoized story for these details, or None if missing or expired."""
+    store, lock = _story_store()
+    with lock:
+        entry = store.get(story_key)
+        if entry is None:
+            return None
+        stored_at, story = entry
+        if time.monotonic() - stored_at > STORY_TTL_SECONDS:
+            del store[story_key]
+            return None
+        store.move_to_end(story_key)
+        return story
+
+def put_cached_story(story_key: tuple, story: str):
+    """Memoizes a finished story for these details, sweeping expired entries and enforcing the size cap."""
+    store, lock = _story_store()
+    now = time.monotonic()
+    with lock:
+        for key in [k for k, (stored_at, _) in store.items() if now - stored_at > STORY_TTL_SECONDS]:
+            del store[key]
+        store[story_key] = (now, story)
+        store.move_to_end(story_key)
+        while len(store) > MAX_STORED_STORIES:
+            store.popitem(last=False)
+
+def coalesce_text(stream, chunks=None, max_chunks=4, max_ms=50):
+    """
+    Extracts only the text from the response objects, yielding it in small bursts
+    (at most max_chunks chunks or max_ms milliseconds) so Streamlit re-renders less often.
+    If a chunks list is given, every text piece is also appended to it for a single join later.
     """
-    # Define the System Instruction
-    system_instruction_text = (
-        "You are a magical storyteller. You must write a creative, engaging, and unique short story "
-        "based ONLY on the user's provided details. Structure the story with an introduction, conflict, and resolution. "
-        "The story should have a clear beginning and end."
+    buf = []
+    t0 = time.monotonic()
+    for chunk in stream:
+        # .text rebuilds the string from the chunk's parts on every access, so read it once
+        text = chunk.text
+        if text:
+            buf.append(text)
+            if chunks is not None:
+                chunks.append(text)
+        if buf and (len(buf) >= max_chunks or (time.monotonic() - t0) * 1000 >= max_ms):
+            yield "".join(buf)
+            buf.clear()
+            t0 = time.monotonic()
+    if buf:
+        yield "".join(buf)
+
+def _story_key(user_details: dict) -> tuple:
+    """Orders the user's details into the key used by the story memo."""
+    return (
+        user_details['name'], user_details['trait'], user_details['hobby'],
+        user_details['setting'], user_details['theme'], user_details['length']
     )
 
-    # Detailed prompt construction based on user inputs
-    prompt = f"""
-    Please write a personalized story for the main character named '{user_details['name']}'.
-    
-    Story Theme/Genre: {user_details['theme']}
-    Key Setting/Location: {user_details['setting']}
-    Length: {user_details['length']} words.
+def render_download_button(name: str, story: str):
+    """Offers the finished story as a plain-text download."""
+    st.download_button(
+        "Download Story",
+        data=story,
+        file_name=f"{name}_story.txt",
+        mime="text/plain"
+    )
 
-    The main character, {user_details['name']}, loves {user_details['hobby']} and their defining personality trait is {user_details['trait']}.
-    Begin the story now:
+def generate_story_stream(generate_stream: Callable, user_details: dict):
+    """
+    Constructs the prompt and streams the generated story.
+    Includes fallback logic for older SDKs that don't support a config with system_instruction.
+    Returns the full story text, or None if generation failed.
     """
-    
     st.subheader(f"📖 The Story of {user_details['name']}")
+
+    # Identical details were already generated: render the cached story without calling the API
+    story_key = _story_key(user_details)
+    story = get_cached_story(story_key)
+    if story is not None:
+        st.markdown(story)
+        render_download_button(user_details['name'], story)
+        return story
+
+    # Detailed prompt construction based on user inputs
+    prompt = build_prompt(user_details)
     
+    # Dispatch on the SDK capability probed once per process
+    story_config = load_story_config()
+    if story_config is not None:
+        # --- Modern SDK (system_instruction passed through GenerateContentConfig) ---
+        kwargs = {'config': story_config}
+    else:
+        # --- FALLBACK: Old SDK, combine system instruction and user prompt into a single contents string ---
+        # Shown at most once per session rather than on every generation
+        if not st.session_state.get("sdk_warn_shown"):
+            st.warning("⚠️ Using legacy SDK method. Please ensure 'google-genai' is updated.")
+            st.session_state["sdk_warn_shown"] = True
+        prompt = FALLBACK_PROMPT_PREFIX + prompt
+        kwargs = {}
+
     try:
-        # --- ATTEMPT 1: Modern SDK (using system_instruction keyword) ---
-        response_stream = client.models.generate_content_stream(
+        response_stream = generate_stream(
             model='gemini-2.5-flash',
             contents=prompt,
-            system_instruction=system_instruction_text
+            **kwargs
         )
         
-        # --- NEW: Helper generator to extract only the text from the response objects ---
-        def text_generator(stream):
-            for chunk in stream:
-                if chunk.text:
-                    yield chunk.text
-
-        # Streamlit's built-in stream writer displays the content as it arrives
-        st.write_stream(text_generator(response_stream))
-        
-    except TypeError as e:
-        # --- FALLBACK: If 'system_instruction' keyword fails, use the old SDK method ---
-        if "'system_instruction'" in str(e):
-            #st.warning("⚠️ Using legacy SDK method. Please ensure 'google-genai' is updated.")
-            
-            # Combine system instruction and user prompt into a single contents string
-            fallback_prompt = f"{system_instruction_text}\n\nUSER PROMPT:\n{prompt}"
-            
-            # Call without system_instruction argument
-            response_stream = client.models.generate_content_stream(
-                model='gemini-2.5-flash',
-                contents=fallback_prompt
-            )
-            
-            # --- NEW: Helper generator for fallback ---
-            def text_generator_fallback(stream):
-                for chunk in stream:
-                    if chunk.text:
-                        yield chunk.text
+        # Streamlit's built-in stream writer displays the content as it arrives;
+        # the pieces are collected in a list and joined once rather than concatenated per chunk
+        chunks = []
+        st.write_stream(coalesce_text(response_stream, chunks))
+        story = "".join(chunks)
 
-            st.write_stream(text_generator_fallback(response_stream))
-        else:
-            # Re-raise other TypeError exceptions
-            raise e
+        # An empty response (e.g. safety-blocked) is neither memoized nor returned
+        if not story:
+            st.error("The model returned an empty story. Please try again or adjust the details.")
+            return None
+
+        # Only completed generations are memoized
+        put_cached_story(story_key, story)
+        render_download_button(user_details['name'], story)
+        return story
             
     except APIError as e:
         st.error(f"An API error occurred during story generation: {e}")
     except Exception as e:
         st.error(f"An unexpected error occurred: {e}")
+    return None
+
+# --- 4. STREAMLIT APP LAYOUT ---
 
-# --- 3. STREAMLIT APP LAYOUT ---
+# Sidebar option lists, built once instead of on every rerun
+_SETTINGS = ("A bustling futuristic city", "An ancient, misty forest", "A remote, ice-covered planet", "A magical library")
+_THEMES = ("Fantasy Adventure", "Sci-Fi Mystery", "Historical Romance", "Modern Comedy")
+_LENGTHS = (200, 350, 500, 750)
+
+def render_last_story():
+    """Re-renders the last successful story of this session without calling the API."""
+    name, story = st.session_state["last_story"]
+    st.subheader(f"📖 The Story of {name}")
+    st.markdown(story)
+    render_download_button(name, story)
 
 def main():
     st.set_page_config(page_title="Personalized Story Maker", layout="wide")
@@ -116,12 +292,13 @@ def main():
         )
         return
 
-    client = load_gemini_client(API_KEY)
-    if client is None:
+    generate_stream = load_story_streamer(API_KEY)
+    if generate_stream is None:
         return
 
     # 3b. User Inputs (Sidebar for cleaner main area)
-    with st.sidebar:
+    # Wrapped in a form so typing doesn't rerun the script until the story is requested
+    with st.sidebar, st.form("story_form", clear_on_submit=False):
         st.header("Character & Story Details")
         
         # Input fields for personalization
@@ -130,17 +307,11 @@ def main():
         hobby = st.text_input("A favorite hobby/interest:", "Stargazing")
         
         st.subheader("World Details")
-        setting = st.selectbox(
-            "Key Setting/Location:",
-            ["A bustling futuristic city", "An ancient, misty forest", "A remote, ice-covered planet", "A magical library"]
-        )
-        theme = st.selectbox(
-            "Story Theme/Genre:",
-            ["Fantasy Adventure", "Sci-Fi Mystery", "Historical Romance", "Modern Comedy"]
-        )
+        setting = st.selectbox("Key Setting/Location:", _SETTINGS)
+        theme = st.selectbox("Story Theme/Genre:", _THEMES)
         length = st.select_slider(
             "Story Length (approximate words):",
-            options=[200, 350, 500, 750],
+            options=_LENGTHS,
             value=350
         )
         
@@ -154,19 +325,29 @@ def main():
             'length': length
         }
 
-    # 3c. Generation Trigger (in the main area)
+        submitted = st.form_submit_button("Generate My Personalized Story!", use_container_width=True, type="primary")
+
+    # 3c. Generation Output (in the main area)
     st.write("---")
 
-    if st.button("Generate My Personalized Story!", use_container_width=True, type="primary"):
-        if not name.strip():
-            st.warning("Please enter a name for your main character.")
-        else:
-            # Clear previous outputs (optional, but nice for clean reruns)
-            st.empty() 
-            
-            # Show a spinner while processing
-            with st.spinner(f"Weaving a {theme} tale about {name}..."):
-                generate_story_stream(client, user_details)
+    # One persistent placeholder: each run replaces its contents in place
+    output = st.empty()
+
+    if submitted:
+        with output.container():
+            if not name.strip():
+                st.warning("Please enter a name for your main character.")
+            else:
+                # Show a spinner while processing; repeated details are served from the story memo
+                with st.spinner(f"Weaving a {theme} tale about {name}..."):
+                    story = generate_story_stream(generate_stream, user_details)
+
+                if story is not None:
+                    st.session_state["last_story"] = (name, story)
+    elif "last_story" in st.session_state:
+        # Reruns from other widgets (e.g. the download button) keep the story on screen
+        with output.container():
+            render_last_story()
                 
     st.markdown("---")
     st.caption("Powered by Google Gemini API and Streamlit.")